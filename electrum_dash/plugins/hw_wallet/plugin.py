@@ -327,7 +327,7 @@ class HardwareHandlerBase:
 
 
 def is_any_tx_output_on_change_branch(tx: PartialTransaction) -> bool:
-    return any([txout.is_change for txout in tx.outputs()])
+    return any(txout.is_change for txout in tx.outputs())
 
 
 def trezor_validate_op_return_output_and_get_data(output: TxOutput) -> bytes:
@@ -350,22 +350,30 @@ def validate_op_return_output(output: TxOutput, *, max_size: int = None) -> None
         raise UserFacingException(_("Amount for OP_RETURN output must be zero."))
 
 
+def get_xfp_to_xpub_and_depth_map(tx: PartialTransaction) -> Dict[bytes, Tuple[str, int]]:
+    return {xfp: (bip32node.to_xpub(), bip32node.depth)
+            for bip32node, (xfp, path) in tx.xpubs.items()}
+
+
 def get_xpubs_and_der_suffixes_from_txinout(tx: PartialTransaction,
-                                            txinout: Union[PartialTxInput, PartialTxOutput]) \
+                                            txinout: Union[PartialTxInput, PartialTxOutput],
+                                            *,
+                                            xfp_to_xpub_and_depth: Optional[Dict[bytes, Tuple[str, int]]] = None) \
         -> List[Tuple[str, List[int]]]:
-    xfp_to_xpub_map = {xfp: bip32node for bip32node, (xfp, path)
-                       in tx.xpubs.items()}  # type: Dict[bytes, BIP32Node]
-    xfps = [txinout.bip32_paths[pubkey][0] for pubkey in txinout.pubkeys]
-    try:
-        xpubs = [xfp_to_xpub_map[xfp] for xfp in xfps]
-    except KeyError as e:
-        raise Exception(f"Partial transaction is missing global xpub for "
-                        f"fingerprint ({str(e)}) in input/output") from e
+    # callers handling many txinouts of the same tx can pass in the
+    # result of get_xfp_to_xpub_and_depth_map(tx) to avoid recomputing it
+    if xfp_to_xpub_and_depth is None:
+        xfp_to_xpub_and_depth = get_xfp_to_xpub_and_depth_map(tx)
     xpubs_and_deriv_suffixes = []
-    for bip32node, pubkey in zip(xpubs, txinout.pubkeys):
+    for pubkey in txinout.pubkeys:
         xfp, path = txinout.bip32_paths[pubkey]
-        der_suffix = list(path)[bip32node.depth:]
-        xpubs_and_deriv_suffixes.append((bip32node.to_xpub(), der_suffix))
+        try:
+            xpub, depth = xfp_to_xpub_and_depth[xfp]
+        except KeyError as e:
+            raise Exception(f"Partial transaction is missing global xpub for "
+                            f"fingerprint ({str(e)}) in input/output") from e
+        der_suffix = list(path)[depth:]
+        xpubs_and_deriv_suffixes.append((xpub, der_suffix))
     return xpubs_and_deriv_suffixes
 
 
@@ -1,10 +1,11 @@
-from binascii import hexlify, unhexlify
+import struct
+import threading
 import traceback
 import sys
 from typing import NamedTuple, Any, Optional, Dict, Union, List, Tuple, TYPE_CHECKING
 
-from electrum_dash.util import bfh, bh2u, versiontuple, UserCancelled, UserFacingException
-from electrum_dash.bip32 import BIP32Node
+from electrum_dash.util import versiontuple, UserCancelled, UserFacingException
+from electrum_dash.bip32 import BIP32Node, convert_bip32_path_to_list_of_uint32
 from electrum_dash import constants
 from electrum_dash.dash_tx import to_varbytes, serialize_extra_payload
 from electrum_dash.i18n import _
@@ -15,7 +16,7 @@ from electrum_dash.base_wizard import ScriptTypeNotSupported
 
 from ..hw_wallet import HW_PluginBase
 from ..hw_wallet.plugin import (is_any_tx_output_on_change_branch, trezor_validate_op_return_output_and_get_data,
-                                get_xpubs_and_der_suffixes_from_txinout)
+                                get_xpubs_and_der_suffixes_from_txinout, get_xfp_to_xpub_and_depth_map)
 
 if TYPE_CHECKING:
     from .client import SafeTClient
@@ -23,6 +24,10 @@ if TYPE_CHECKING:
 # Safe-T mini initialization methods
 TIM_NEW, TIM_RECOVER, TIM_MNEMONIC, TIM_PRIVKEY = range(0, 4)
 
+_u32_be = struct.Struct('>I').unpack
+
+_COINBASE_PREV_HASH = b"\x00"*32
+
 
 class SafeTKeyStore(Hardware_KeyStore):
     hw_type = 'safe_t'
@@ -30,21 +35,31 @@ class SafeTKeyStore(Hardware_KeyStore):
 
     plugin: 'SafeTPlugin'
 
+    # (derivation prefix, same prefix as list of ints)
+    _prefix_n = None  # type: Optional[Tuple[str, List[int]]]
+
     def get_client(self, force_pair=True):
         return self.plugin.get_client(self, force_pair)
 
+    def get_address_n(self, change: int, index: int) -> List[int]:
+        derivation = self.get_derivation_prefix()
+        if self._prefix_n is None or self._prefix_n[0] != derivation:
+            self._prefix_n = (derivation, convert_bip32_path_to_list_of_uint32(derivation))
+        return self._prefix_n[1] + [change, index]
+
     def decrypt_message(self, sequence, message, password):
         raise UserFacingException(_('Encryption and decryption are not implemented by {}').format(self.device))
 
-    @runs_in_hwd_thread
     def sign_message(self, sequence, message, password):
+        address_n = self.get_address_n(*sequence)
+        return self._do_sign_message(address_n, message)
+
+    @runs_in_hwd_thread
+    def _do_sign_message(self, address_n: List[int], message):
         client = self.get_client()
-        address_path = self.get_derivation_prefix() + "/%d/%d"%sequence
-        address_n = client.expand_path(address_path)
         msg_sig = client.sign_message(self.plugin.get_coin_name(), address_n, message)
         return msg_sig.signature
 
-    @runs_in_hwd_thread
     def sign_transaction(self, tx, password):
         if tx.is_complete():
             return
@@ -88,6 +103,9 @@ class SafeTPlugin(HW_PluginBase):
         self.client_class = client.SafeTClient
         self.types = safetlib.messages
         self.DEVICE_IDS = ('Safe-T mini',)
+        # previous txs of the tx being signed, and their TransactionType conversions
+        self.prev_tx = {}  # type: Dict[str, Optional[Transaction]]
+        self._prev_tx_cache = {}  # type: Dict[str, Any]
 
         self.transport_handler = transport.SafeTTransport()
         self.device_manager().register_enumerate_func(self.enumerate)
@@ -178,7 +196,6 @@ class SafeTPlugin(HW_PluginBase):
             (TIM_PRIVKEY, _("Upload a master private key"))
         ]
         def f(method):
-            import threading
             settings = self.request_safe_t_init_settings(wizard, method, self.device)
             t = threading.Thread(target=self._initialize_device_safe, args=(settings, method, device_id, wizard, handler))
             t.setDaemon(True)
@@ -245,15 +262,19 @@ class SafeTPlugin(HW_PluginBase):
             client.load_device_by_xprv(item, pin, passphrase_protection,
                                        label, language)
 
-    def _make_node_path(self, xpub, address_n):
-        bip32node = BIP32Node.from_xkey(xpub)
-        node = self.types.HDNodeType(
-            depth=bip32node.depth,
-            fingerprint=int.from_bytes(bip32node.fingerprint, 'big'),
-            child_num=int.from_bytes(bip32node.child_number, 'big'),
-            chain_code=bip32node.chaincode,
-            public_key=bip32node.eckey.get_public_key_bytes(compressed=True),
-        )
+    def _make_node_path(self, xpub, address_n, node_cache: Optional[Dict[str, Any]] = None):
+        node = node_cache.get(xpub) if node_cache is not None else None
+        if node is None:
+            bip32node = BIP32Node.from_xkey(xpub)
+            node = self.types.HDNodeType(
+                depth=bip32node.depth,
+                fingerprint=_u32_be(bip32node.fingerprint)[0],
+                child_num=_u32_be(bip32node.child_number)[0],
+                chain_code=bip32node.chaincode,
+                public_key=bip32node.eckey.get_public_key_bytes(compressed=True),
+            )
+            if node_cache is not None:
+                node_cache[xpub] = node
         return self.types.HDNodePathType(node=node, address_n=address_n)
 
     def setup_device(self, device_info, wizard, purpose):
@@ -288,15 +309,27 @@ class SafeTPlugin(HW_PluginBase):
             return self.types.OutputScriptType.PAYTOMULTISIG
         raise ValueError('unexpected txin type: {}'.format(electrum_txin_type))
 
-    @runs_in_hwd_thread
     def sign_transaction(self, keystore, tx: PartialTransaction, prev_tx):
+        # Building the device messages is pure Python work, so do it here
+        # and only occupy the hwd thread for the actual device exchange.
+        inputs, outputs = self._prepare_sign_transaction(keystore, tx)
+        self._device_sign(keystore, tx, prev_tx, inputs, outputs)
+
+    def _prepare_sign_transaction(self, keystore, tx: PartialTransaction):
+        # per call, as this may run concurrently on several caller threads
+        node_cache = {}  # type: Dict[str, Any]
+        inputs = self.tx_inputs(tx, for_sig=True, keystore=keystore, node_cache=node_cache)
+        outputs = self.tx_outputs(tx, keystore=keystore, node_cache=node_cache)
+        return inputs, outputs
+
+    @runs_in_hwd_thread
+    def _device_sign(self, keystore, tx: PartialTransaction, prev_tx, inputs, outputs):
         self.prev_tx = prev_tx
+        self._prev_tx_cache = {}
         client = self.get_client(keystore)
-        inputs = self.tx_inputs(tx, for_sig=True, keystore=keystore)
-        outputs = self.tx_outputs(tx, keystore=keystore)
         signatures = client.sign_tx(self.get_coin_name(), inputs, outputs,
                                     lock_time=tx.locktime, version=tx.version)[0]
-        signatures = [(bh2u(x) + '01') for x in signatures]
+        signatures = [x.hex() + '01' for x in signatures]
         tx.update_signatures(signatures)
 
     @runs_in_hwd_thread
@@ -310,9 +343,7 @@ class SafeTPlugin(HW_PluginBase):
             keystore.handler.show_error(_("Your device firmware is too old"))
             return
         deriv_suffix = wallet.get_address_index(address)
-        derivation = keystore.get_derivation_prefix()
-        address_path = "%s/%d/%d"%(derivation, *deriv_suffix)
-        address_n = client.expand_path(address_path)
+        address_n = keystore.get_address_n(*deriv_suffix)
         script_type = self.get_safet_input_script_type(wallet.txin_type)
 
         # prepare multisig, if available:
@@ -329,25 +360,35 @@ class SafeTPlugin(HW_PluginBase):
 
         client.get_address(self.get_coin_name(), address_n, True, multisig=multisig, script_type=script_type)
 
-    def tx_inputs(self, tx: Transaction, *, for_sig=False, keystore: 'SafeTKeyStore' = None):
-        inputs = []
-        for txin in tx.inputs():
-            txinputtype = self.types.TxInputType()
+    def tx_inputs(self, tx: Transaction, *, for_sig=False, keystore: 'SafeTKeyStore' = None,
+                  node_cache: Optional[Dict[str, Any]] = None):
+        if for_sig:
+            assert isinstance(tx, PartialTransaction)
+            assert keystore
+            # the cosigner xpubs are the same for every input
+            xfp_to_xpub_and_depth = get_xfp_to_xpub_and_depth_map(tx)
+        TxInputType = self.types.TxInputType
+        get_script_type = self.get_safet_input_script_type
+        make_multisig = self._make_multisig
+        txins = tx.inputs()
+        inputs = [None] * len(txins)
+        for i, txin in enumerate(txins):
             if txin.is_coinbase_input():
-                prev_hash = b"\x00"*32
+                txinputtype = TxInputType()
+                prev_hash = _COINBASE_PREV_HASH
                 prev_index = 0xffffffff  # signed int -1
             else:
-                if for_sig:
-                    assert isinstance(tx, PartialTransaction)
-                    assert isinstance(txin, PartialTxInput)
-                    assert keystore
+                if not for_sig:
+                    txinputtype = TxInputType()
+                else:
                     if len(txin.pubkeys) > 1:
-                        xpubs_and_deriv_suffixes = get_xpubs_and_der_suffixes_from_txinout(tx, txin)
-                        multisig = self._make_multisig(txin.num_sig, xpubs_and_deriv_suffixes)
+                        xpubs_and_deriv_suffixes = get_xpubs_and_der_suffixes_from_txinout(
+                            tx, txin, xfp_to_xpub_and_depth=xfp_to_xpub_and_depth)
+                        multisig = make_multisig(txin.num_sig, xpubs_and_deriv_suffixes, node_cache)
                     else:
                         multisig = None
-                    script_type = self.get_safet_input_script_type(txin.script_type)
-                    txinputtype = self.types.TxInputType(
+                    script_type = get_script_type(txin.script_type)
+                    txinputtype = TxInputType(
                         script_type=script_type,
                         multisig=multisig)
                     my_pubkey, full_path = keystore.find_my_pubkey_in_txinout(txin)
@@ -367,31 +408,36 @@ class SafeTPlugin(HW_PluginBase):
 
             txinputtype.sequence = txin.nsequence
 
-            inputs.append(txinputtype)
+            inputs[i] = txinputtype
 
         return inputs
 
-    def _make_multisig(self, m, xpubs):
+    def _make_multisig(self, m, xpubs, node_cache: Optional[Dict[str, Any]] = None):
         if len(xpubs) == 1:
             return None
-        pubkeys = [self._make_node_path(xpub, deriv) for xpub, deriv in xpubs]
+        pubkeys = [self._make_node_path(xpub, deriv, node_cache) for xpub, deriv in xpubs]
         return self.types.MultisigRedeemScriptType(
             pubkeys=pubkeys,
             signatures=[b''] * len(pubkeys),
             m=m)
 
-    def tx_outputs(self, tx: PartialTransaction, *, keystore: 'SafeTKeyStore'):
+    def tx_outputs(self, tx: PartialTransaction, *, keystore: 'SafeTKeyStore',
+                   node_cache: Optional[Dict[str, Any]] = None):
+        TxOutputType = self.types.TxOutputType
+        OutputScriptType = self.types.OutputScriptType
+        get_script_type = self.get_safet_output_script_type
+        make_multisig = self._make_multisig
 
         def create_output_by_derivation():
-            script_type = self.get_safet_output_script_type(txout.script_type)
+            script_type = get_script_type(txout.script_type)
             if len(txout.pubkeys) > 1:
                 xpubs_and_deriv_suffixes = get_xpubs_and_der_suffixes_from_txinout(tx, txout)
-                multisig = self._make_multisig(txout.num_sig, xpubs_and_deriv_suffixes)
+                multisig = make_multisig(txout.num_sig, xpubs_and_deriv_suffixes, node_cache)
             else:
                 multisig = None
             my_pubkey, full_path = keystore.find_my_pubkey_in_txinout(txout)
             assert full_path
-            txoutputtype = self.types.TxOutputType(
+            txoutputtype = TxOutputType(
                 multisig=multisig,
                 amount=txout.value,
                 address_n=full_path,
@@ -399,21 +445,22 @@ class SafeTPlugin(HW_PluginBase):
             return txoutputtype
 
         def create_output_by_address():
-            txoutputtype = self.types.TxOutputType()
+            txoutputtype = TxOutputType()
             txoutputtype.amount = txout.value
             if address:
-                txoutputtype.script_type = self.types.OutputScriptType.PAYTOADDRESS
+                txoutputtype.script_type = OutputScriptType.PAYTOADDRESS
                 txoutputtype.address = address
             else:
-                txoutputtype.script_type = self.types.OutputScriptType.PAYTOOPRETURN
+                txoutputtype.script_type = OutputScriptType.PAYTOOPRETURN
                 txoutputtype.op_return_data = trezor_validate_op_return_output_and_get_data(txout)
             return txoutputtype
 
-        outputs = []
         has_change = False
         any_output_on_change_branch = is_any_tx_output_on_change_branch(tx)
+        txouts = tx.outputs()
+        outputs = [None] * len(txouts)
 
-        for txout in tx.outputs():
+        for i, txout in enumerate(txouts):
             address = txout.address
             use_create_by_derivation = False
 
@@ -430,7 +477,7 @@ class SafeTPlugin(HW_PluginBase):
                 txoutputtype = create_output_by_derivation()
             else:
                 txoutputtype = create_output_by_address()
-            outputs.append(txoutputtype)
+            outputs[i] = txoutputtype
 
         return outputs
 
@@ -457,5 +504,8 @@ class SafeTPlugin(HW_PluginBase):
 
     # This function is called from the TREZOR libraries (via tx_api)
     def get_tx(self, tx_hash):
-        tx = self.prev_tx[tx_hash]
-        return self.electrum_tx_to_txtype(tx)
+        t = self._prev_tx_cache.get(tx_hash)
+        if t is None:
+            tx = self.prev_tx[tx_hash]
+            t = self._prev_tx_cache[tx_hash] = self.electrum_tx_to_txtype(tx)
+        return t
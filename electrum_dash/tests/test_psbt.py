@@ -2,6 +2,8 @@ from pprint import pprint
 import unittest
 
 from electrum_dash import constants
+from electrum_dash.plugins.hw_wallet.plugin import (get_xpubs_and_der_suffixes_from_txinout,
+                                                    get_xfp_to_xpub_and_depth_map)
 from electrum_dash.transaction import (tx_from_any, PartialTransaction, BadHeaderMagic, UnexpectedEndOfStream,
                                   SerializationError, PSBTInputConsistencyFailure)
 
@@ -179,3 +181,43 @@ class TestPSBTComplexChecks(TestCaseForTestnet):
         tx1.combine_with_other_psbt(tx2)
         self.assertEqual("70736274ff01003f0200000001ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff0000000000ffffffff010000000000000000036a0100000000000a0f0102030405060708090f0102030405060708090a0b0c0d0e0f0a0f0102030405060708100f0102030405060708090a0b0c0d0e0f000a0f0102030405060708090f0102030405060708090a0b0c0d0e0f0a0f0102030405060708100f0102030405060708090a0b0c0d0e0f000a0f0102030405060708090f0102030405060708090a0b0c0d0e0f0a0f0102030405060708100f0102030405060708090a0b0c0d0e0f00",
                          tx1.serialize_as_bytes().hex())
+
+
+class TestPSBTHWWalletHelpers(TestCaseForTestnet):
+
+    def _get_2of2_multisig_psbt(self):
+        # 2of2 p2sh multisig spending to a cosigner address and to change; has global xpubs
+        tx = tx_from_any('70736274ff0100730200000001a63c77e70cfefcbc929e2304c9370ad498f1bf3e96e76ee82a6f82e6a256c7760000000000feffffff02389d07000000000017a914fc159bd97213d62cb8f24a6c197b2a77d94152b78720a107000000000017a91417570b4fd26600e680a36aa9f37c4ac3c0d61af387000000004f01043587cf000000000000000000d4984a1f546a220304f7728d8d5a8c3b5706cdfae8a43cca1ed31c3c916ded9d0375d9b6fc435859c1e83f5c3166252be42543cb0210a0ead783f37b2d0190bb5404db6924274f01043587cf000000000000000000619f2e794175de138a4dfa6cd52f9d9dd2678cd536d05be5346d3470972b8b1c027a3c9e5512c8c50dea0b7a62249fe2a34a4f5591edbf927fb268f190d00fa6760448adc7a000010053020000000111111111111111111111111111111111111111111111111111111111111111110000000000ffffffff0140420f000000000017a91417570b4fd26600e680a36aa9f37c4ac3c0d61af387000000000104475221030b482838721a38d94847699fed8818b5c5f56500ef72f13489e365b65e5749cf2103e5db7969ae2f2576e6a061bf3bb2db16571e77ffb41e0b27170734359235cbce52ae2206030b482838721a38d94847699fed8818b5c5f56500ef72f13489e365b65e5749cf0c48adc7a00000000000000000220603e5db7969ae2f2576e6a061bf3bb2db16571e77ffb41e0b27170734359235cbce0cdb6924270000000000000000000100475221022ec6f62b0f3b7c2446f44346bff0a6f06b5fdbc27368be8a36478e0287fe47be2102b7139e93747d7c77f62af5a38b8a2b009f3456aa94dea9bf21f73a6298c867a252ae2202022ec6f62b0f3b7c2446f44346bff0a6f06b5fdbc27368be8a36478e0287fe47be0cdb6924270100000000000000220202b7139e93747d7c77f62af5a38b8a2b009f3456aa94dea9bf21f73a6298c867a20c48adc7a00100000000000000000100475221030b482838721a38d94847699fed8818b5c5f56500ef72f13489e365b65e5749cf2103e5db7969ae2f2576e6a061bf3bb2db16571e77ffb41e0b27170734359235cbce52ae2202030b482838721a38d94847699fed8818b5c5f56500ef72f13489e365b65e5749cf0c48adc7a00000000000000000220203e5db7969ae2f2576e6a061bf3bb2db16571e77ffb41e0b27170734359235cbce0cdb692427000000000000000000')
+        for txinout in tx.inputs() + tx.outputs():
+            txinout.pubkeys = sorted(txinout.bip32_paths)
+        return tx
+
+    def test_get_xpubs_and_der_suffixes_from_txinout_with_precomputed_map(self):
+        tx = self._get_2of2_multisig_psbt()
+        xfp_to_xpub_and_depth = get_xfp_to_xpub_and_depth_map(tx)
+        for txinout in tx.inputs() + tx.outputs():
+            self.assertEqual(get_xpubs_and_der_suffixes_from_txinout(tx, txinout),
+                             get_xpubs_and_der_suffixes_from_txinout(
+                                 tx, txinout, xfp_to_xpub_and_depth=xfp_to_xpub_and_depth))
+        self.assertEqual([('tpubD6NzVbkrYhZ4XJzYkhsCbDCcZRmDAKSD7bXi9mdCni7acVt45fxbTVZyU6jRGh29ULKTjoapkfFsSJvQHitcVKbQgzgkkYsAmaovcro7Mhf', [0, 0]),
+                          ('tpubD6NzVbkrYhZ4YTPEgwk4zzr8wyo7pXGmbbVUnfYNtx6SgAMF5q3LN3Kch58P9hxGNsTmP7Dn49nnrmpE6upoRb1Xojg12FGLuLHkVpVtS44', [0, 0])],
+                         get_xpubs_and_der_suffixes_from_txinout(
+                             tx, tx.inputs()[0], xfp_to_xpub_and_depth=xfp_to_xpub_and_depth))
+        self.assertEqual([('tpubD6NzVbkrYhZ4YTPEgwk4zzr8wyo7pXGmbbVUnfYNtx6SgAMF5q3LN3Kch58P9hxGNsTmP7Dn49nnrmpE6upoRb1Xojg12FGLuLHkVpVtS44', [1, 0]),
+                          ('tpubD6NzVbkrYhZ4XJzYkhsCbDCcZRmDAKSD7bXi9mdCni7acVt45fxbTVZyU6jRGh29ULKTjoapkfFsSJvQHitcVKbQgzgkkYsAmaovcro7Mhf', [1, 0])],
+                         get_xpubs_and_der_suffixes_from_txinout(
+                             tx, tx.outputs()[0], xfp_to_xpub_and_depth=xfp_to_xpub_and_depth))
+
+    def test_get_xpubs_and_der_suffixes_from_txinout_missing_global_xpub(self):
+        tx = self._get_2of2_multisig_psbt()
+        for bip32node, (xfp, path) in list(tx.xpubs.items()):
+            if xfp == bytes.fromhex('48adc7a0'):
+                del tx.xpubs[bip32node]
+        xfp_to_xpub_and_depth = get_xfp_to_xpub_and_depth_map(tx)
+        expected_msg = "Partial transaction is missing global xpub for fingerprint (b'H\\xad\\xc7\\xa0') in input/output"
+        with self.assertRaises(Exception) as ctx:
+            get_xpubs_and_der_suffixes_from_txinout(tx, tx.inputs()[0])
+        self.assertEqual(expected_msg, str(ctx.exception))
+        with self.assertRaises(Exception) as ctx:
+            get_xpubs_and_der_suffixes_from_txinout(tx, tx.inputs()[0], xfp_to_xpub_and_depth=xfp_to_xpub_and_depth)
+        self.assertEqual(expected_msg, str(ctx.exception))